@@ -1,11 +1,17 @@
 from fastapi import FastAPI, HTTPException, Query
-import requests
+from fastapi.responses import ORJSONResponse, Response
+import httpx
+import orjson
 import re
-import random
+import itertools
+from ipaddress import IPv4Address, AddressValueError
 import os
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Union, Callable, Awaitable, NamedTuple, Tuple
 import logging
-from datetime import datetime, timezone
+import time
+import asyncio
+import functools
+from cachetools import TTLCache
 
 # 配置日志
 logging.basicConfig(
@@ -14,61 +20,125 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger(__name__)
+# httpx/httpcore 在INFO级别记录完整请求URL（含AK/Key），调高级别避免密钥写入日志
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
 
-app = FastAPI(title="IP Location Query API", version="3.2")
+app = FastAPI(title="IP Location Query API", version="3.2", default_response_class=ORJSONResponse)
 
 # 从环境变量读取默认密钥（避免硬编码）
 BAIDU_DEFAULT_AK = os.getenv("BAIDU_DEFAULT_AK", "")
 AMAP_DEFAULT_KEY = os.getenv("AMAP_DEFAULT_KEY", "")
 
-# -------------------------- 工具函数 --------------------------
-def is_valid_ip(ip: str) -> bool:
-    """验证IPv4格式，防范恶意输入"""
-    ip_pattern = re.compile(
-        r'^((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.)'
-        r'{3}(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$'
+# 全局异步HTTP客户端（复用连接池，避免阻塞事件循环）
+# 上游仅4个固定域名，延长keep-alive以复用TCP/TLS连接，避免重复握手
+# 显式声明接受gzip压缩响应（httpx自动解压），并标识服务自身的User-Agent
+# HTTPS上游经ALPN协商HTTP/2，单连接多路复用并发请求；不支持时自动回退HTTP/1.1
+client = httpx.AsyncClient(
+    timeout=5.0,
+    http2=True,
+    headers={"Accept-Encoding": "gzip, deflate", "User-Agent": f"ip-location-api/{app.version}"},
+    limits=httpx.Limits(
+        max_connections=100,
+        max_keepalive_connections=50,
+        keepalive_expiry=30.0
     )
-    return ip_pattern.match(ip) is not None
+)
 
-def extract_location_from_baidu_opendata(raw_data: Dict[str, Any]) -> Dict[str, str]:
-    """从百度开放平台原生响应提取省市信息（无硬编码）"""
-    location = raw_data.get("data", [{}])[0].get("location", "").strip()
-    location_clean = re.sub(r'\s+[^ ]*$', '', location).strip()  # 移除运营商
-    
+@app.on_event("shutdown")
+async def close_http_client() -> None:
+    """服务关闭时释放HTTP连接池"""
+    await client.aclose()
+
+@app.on_event("startup")
+async def warm_up() -> None:
+    """启动预热：提前走一遍IP校验、省市提取、格式转换与JSON序列化，避免首个请求承担初始化开销"""
+    parse_ipv4("1.2.3.4")
+    samples = (
+        ("百度开放平台", {"status": "0", "data": [{"location": "广东省深圳市 电信"}]}),
+        ("PConline", {"pro": "广东省", "city": "深圳市", "proCode": "440000", "cityCode": "440300"})
+    )
+    for upstream, raw_data in samples:
+        orjson.dumps(to_baidumap_format(raw_data, "1.2.3.4", upstream))
+        orjson.dumps(to_amap_format(raw_data, "1.2.3.4", upstream))
+
+# 查询结果缓存（IP地理位置数据短期内稳定，命中时免去上游往返）
+# 成功结果缓存1小时；全部上游失败的结果缓存60秒，避免持续冲击故障上游
+_LOC_CACHE: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
+_LOC_NEG_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+# 上游原生响应缓存（通用接口/高德风格接口共用，6小时内同一上游同一IP只请求一次）
+# 容量按4个上游各约1万条估算
+_UPSTREAM_RAW_CACHE: TTLCache = TTLCache(maxsize=40_000, ttl=21600)
+
+# 省级/地级行政区关键词
+_PROVINCE_KEYWORDS = ("省", "自治区", "直辖市", "特别行政区")
+_CITY_KEYWORDS = ("市", "州", "盟", "地区")
+# 直辖市/特别行政区判断（预编译，单次扫描匹配全部关键词）
+_MUNICIPALITY_RE = re.compile("直辖市|特别行政区")
+
+# -------------------------- 工具函数 --------------------------
+class LocationInfo(NamedTuple):
+    """上游响应中提取的省市信息（轻量不可变容器，无字段校验开销）"""
+    province: str = ""
+    city: str = ""
+    adcode: str = ""
+
+def parse_ipv4(ip: str) -> Optional[int]:
+    """解析并校验IPv4地址，返回其32位整数形式（用作缓存键），格式无效返回None"""
+    # 快速拒绝：长度或点号数量不符的输入（扫描器/乱码）无需进入完整解析
+    if len(ip) < 7 or len(ip) > 15 or ip.count('.') != 3:
+        return None
+    try:
+        return int(IPv4Address(ip))
+    except (AddressValueError, ValueError):
+        return None
+
+def _split_province_city(location: str) -> Tuple[str, str, str]:
+    """
+    按关键词拆分地址字符串，返回 (省份, 城市, 省份之后的剩余部分)
+    每个关键词仅用一次 str.find 定位，按关键词优先级（而非出现位置）匹配，
+    避免"广州市"被"州"提前截断为"广州"
+    """
     # 提取省份（基于省级关键词）
-    province_keywords = ("省", "自治区", "直辖市", "特别行政区")
     province = ""
-    remaining = location_clean
-    for kw in province_keywords:
-        if kw in location_clean:
-            parts = location_clean.split(kw, 1)
-            if len(parts) >= 2:
-                province = f"{parts[0].strip()}{kw}"
-                remaining = parts[1].strip()
+    remaining = location
+    for kw in _PROVINCE_KEYWORDS:
+        idx = location.find(kw)
+        if idx >= 0:
+            province = f"{location[:idx].strip()}{kw}"
+            remaining = location[idx + len(kw):].strip()
             break
     
     # 提取城市（基于地级关键词）
-    city_keywords = ("市", "州", "盟", "地区")
     city = ""
-    for kw in city_keywords:
-        if kw in remaining:
-            parts = remaining.split(kw, 1)
-            city = f"{parts[0].strip()}{kw}"
+    for kw in _CITY_KEYWORDS:
+        idx = remaining.find(kw)
+        if idx >= 0:
+            city = f"{remaining[:idx].strip()}{kw}"
             break
+    return province, city, remaining
+
+def extract_location_from_baidu_opendata(raw_data: Dict[str, Any]) -> LocationInfo:
+    """从百度开放平台原生响应提取省市信息（无硬编码）"""
+    location = raw_data.get("data", [{}])[0].get("location", "").strip()
+    parts = location.rsplit(None, 1)  # 移除运营商（末尾以空白分隔的一段）
+    location_clean = parts[0].strip() if len(parts) > 1 else location
+    
+    province, city, remaining = _split_province_city(location_clean)
     if not city and remaining:
         city = remaining.strip()
     if not city:
         city = province  # 直辖市兜底
     
     # 非直辖市校验
-    is_municipality = any(kw in province for kw in ("直辖市", "特别行政区"))
+    is_municipality = _MUNICIPALITY_RE.search(province) is not None
     if city == province and not is_municipality:
         city_candidates = [seg.strip() for seg in remaining.split() if seg.strip()]
         city = city_candidates[0] if city_candidates else province
     
-    return {"province": province.strip(), "city": city.strip(), "adcode": ""}
+    return LocationInfo(province.strip(), city.strip(), "")
 
-def extract_location_from_pconline(raw_data: Dict[str, Any]) -> Dict[str, str]:
+def extract_location_from_pconline(raw_data: Dict[str, Any]) -> LocationInfo:
     """从PConline原生响应提取省市信息"""
     province = raw_data.get("pro", "").strip()
     city = raw_data.get("city", "").strip()
@@ -78,35 +148,47 @@ def extract_location_from_pconline(raw_data: Dict[str, Any]) -> Dict[str, str]:
     
     # 处理直辖市/缺失情况
     if not city or city == province:
-        is_municipality = any(kw in province for kw in ("直辖市", "特别行政区"))
+        is_municipality = _MUNICIPALITY_RE.search(province) is not None
         if is_municipality:
             city = province
         else:
             city = raw_data.get("addr", "").replace(province, "").strip().split()[0]
     
-    return {"province": province, "city": city, "adcode": adcode}
+    return LocationInfo(province, city, adcode)
+
+def extract_location_from_amap(raw_data: Dict[str, Any]) -> LocationInfo:
+    """从高德地图原生响应提取省市信息（字段本身无多余空白，无需strip；未知IP时字段为空列表）"""
+    return LocationInfo(
+        raw_data.get("province") or "",
+        raw_data.get("city") or "",
+        raw_data.get("adcode") or ""
+    )
+
+def extract_location_from_baidu_map(raw_data: Dict[str, Any]) -> LocationInfo:
+    """从百度地图原生响应提取省市信息（结构化字段无需strip）"""
+    addr_detail = raw_data.get("content", {}).get("address_detail", {})
+    return LocationInfo(
+        addr_detail.get("province") or "",
+        addr_detail.get("city") or "",
+        addr_detail.get("adcode") or ""
+    )
+
+# 上游名称 → 省市提取函数（格式化时一次字典查找完成分发）
+_EXTRACTORS: Dict[str, Callable[[Dict[str, Any]], LocationInfo]] = {
+    "百度地图原生接口": extract_location_from_baidu_map,
+    "高德地图原生接口": extract_location_from_amap,
+    "百度开放平台": extract_location_from_baidu_opendata,
+    "PConline": extract_location_from_pconline
+}
 
 # -------------------------- 格式化函数（核心新增） --------------------------
 def to_baidumap_format(raw_data: Dict[str, Any], ip: str, upstream: str) -> Dict[str, Any]:
     """将任意上游的原生响应转换为百度地图原生格式"""
-    location_info = {"province": "", "city": "", "adcode": ""}
-    
-    # 按上游类型提取基础信息
-    if upstream == "高德地图原生接口":
-        location_info["province"] = raw_data.get("province", "").strip()
-        location_info["city"] = raw_data.get("city", "").strip()
-        location_info["adcode"] = raw_data.get("adcode", "").strip()
-    elif upstream == "百度开放平台":
-        location_info = extract_location_from_baidu_opendata(raw_data)
-    elif upstream == "PConline":
-        location_info = extract_location_from_pconline(raw_data)
-    elif upstream == "百度地图原生接口":
+    if upstream == "百度地图原生接口":
         return raw_data  # 本身就是百度格式，直接返回
     
-    # 构建百度原生格式
-    province = location_info["province"]
-    city = location_info["city"]
-    adcode = location_info["adcode"]
+    # 按上游类型提取基础信息，构建百度原生格式
+    province, city, adcode = _EXTRACTORS[upstream](raw_data)
     
     return {
         "status": 0,
@@ -131,26 +213,11 @@ def to_baidumap_format(raw_data: Dict[str, Any], ip: str, upstream: str) -> Dict
 
 def to_amap_format(raw_data: Dict[str, Any], ip: str, upstream: str) -> Dict[str, Any]:
     """将任意上游的原生响应转换为高德地图原生格式"""
-    location_info = {"province": "", "city": "", "adcode": ""}
-    
-    # 按上游类型提取基础信息
-    if upstream == "百度地图原生接口":
-        content = raw_data.get("content", {})
-        addr_detail = content.get("address_detail", {})
-        location_info["province"] = addr_detail.get("province", "").strip()
-        location_info["city"] = addr_detail.get("city", "").strip()
-        location_info["adcode"] = addr_detail.get("adcode", "").strip()
-    elif upstream == "百度开放平台":
-        location_info = extract_location_from_baidu_opendata(raw_data)
-    elif upstream == "PConline":
-        location_info = extract_location_from_pconline(raw_data)
-    elif upstream == "高德地图原生接口":
+    if upstream == "高德地图原生接口":
         return raw_data  # 本身就是高德格式，直接返回
     
-    # 构建高德原生格式
-    province = location_info["province"]
-    city = location_info["city"]
-    adcode = location_info["adcode"]
+    # 按上游类型提取基础信息，构建高德原生格式
+    province, city, adcode = _EXTRACTORS[upstream](raw_data)
     
     return {
         "status": "1" if province else "0",
@@ -163,83 +230,405 @@ def to_amap_format(raw_data: Dict[str, Any], ip: str, upstream: str) -> Dict[str
     }
 
 # -------------------------- 上游原生接口调用函数 --------------------------
-def query_baidu_map_native(ip: str, coor: str, ak: str) -> Optional[Dict[str, Any]]:
+# 返回值约定：成功返回原生响应；上游正常应答但该IP无数据（内网/境外/未知IP）返回空字典；
+# 网络异常、超时、HTTP错误、鉴权/配额错误等上游故障返回None（仅此类计入熔断失败）
+def cache_raw_response(upstream: str):
+    """上游原生响应缓存装饰器：按 (上游名称, 调用参数) 缓存成功响应，失败结果不缓存"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args: str) -> Optional[Dict[str, Any]]:
+            cache_key = (upstream, *args)
+            cached = _UPSTREAM_RAW_CACHE.get(cache_key)
+            if cached is not None:
+                logger.debug("IP:%s - %s命中原生响应缓存", args[0], upstream)
+                return cached
+            raw_data = await func(*args)
+            if raw_data:
+                _UPSTREAM_RAW_CACHE[cache_key] = raw_data
+            return raw_data
+        # 仅查缓存不请求上游，供调度层在熔断判断前识别缓存命中
+        wrapper.peek_cache = lambda *args: _UPSTREAM_RAW_CACHE.get((upstream, *args))
+        return wrapper
+    return decorator
+
+# 百度地图：1 为IP定位失败（内网/境外IP），2 为请求参数非法，均属单个IP无数据而非上游故障
+_BAIDU_NO_DATA_STATUS = (1, 2)
+
+@cache_raw_response("百度地图原生接口")
+async def query_baidu_map_native(ip: str, coor: str, ak: str) -> Optional[Dict[str, Any]]:
     """百度地图原生接口调用"""
-    logger.info(f"IP:{ip} - 选用上游接口：百度地图原生接口")
+    logger.debug("IP:%s - 选用上游接口：百度地图原生接口", ip)
     if not ak:
-        logger.warning(f"IP:{ip} - 百度AK为空，跳过")
+        logger.warning("IP:%s - 百度AK为空，跳过", ip)
         return None
     try:
         url = "https://api.map.baidu.com/location/ip"
         params = {"ip": ip, "coor": coor, "ak": ak}
-        logger.debug(f"IP:{ip} - 百度请求参数: {params}（AK脱敏）")
-        response = requests.get(url, params=params, timeout=5)
+        logger.debug("IP:%s - 百度请求参数: %s（AK脱敏）", ip, params)
+        response = await client.get(url, params=params)
         response.raise_for_status()
-        raw_data = response.json()
-        logger.debug(f"IP:{ip} - 百度原生响应: {raw_data}")
-        return raw_data
+        raw_data = orjson.loads(response.content)
+        logger.debug("IP:%s - 百度原生响应: %s", ip, raw_data)
+        # HTTP 200 也可能携带错误（AK无效/配额超限等），仅 status == 0 视为成功
+        status = raw_data.get("status")
+        if status == 0:
+            return raw_data
+        if status in _BAIDU_NO_DATA_STATUS:
+            logger.info("IP:%s - 百度原生接口无该IP数据: %s", ip, raw_data.get("message"))
+            return {}
+        logger.warning("IP:%s - 百度原生接口响应异常: %s", ip, raw_data)
+        return None
     except Exception as e:
-        logger.error(f"IP:{ip} - 百度原生接口失败: {str(e)}", exc_info=True)
+        logger.error("IP:%s - 百度原生接口失败: %s", ip, e, exc_info=logger.isEnabledFor(logging.DEBUG))
         return None
 
-def query_amap_ip_native(ip: str, key: str) -> Optional[Dict[str, Any]]:
+@cache_raw_response("高德地图原生接口")
+async def query_amap_ip_native(ip: str, key: str) -> Optional[Dict[str, Any]]:
     """高德地图原生接口调用"""
-    logger.info(f"IP:{ip} - 选用上游接口：高德地图原生接口")
+    logger.debug("IP:%s - 选用上游接口：高德地图原生接口", ip)
     if not key:
-        logger.warning(f"IP:{ip} - 高德Key为空，跳过")
+        logger.warning("IP:%s - 高德Key为空，跳过", ip)
         return None
     try:
         url = "https://restapi.amap.com/v3/ip"
         params = {"ip": ip, "key": key}
-        logger.debug(f"IP:{ip} - 高德请求参数: {params}（Key脱敏）")
-        response = requests.get(url, params=params, timeout=5)
+        logger.debug("IP:%s - 高德请求参数: %s（Key脱敏）", ip, params)
+        response = await client.get(url, params=params)
         response.raise_for_status()
-        raw_data = response.json()
-        logger.debug(f"IP:{ip} - 高德原生响应: {raw_data}")
-        return raw_data
+        raw_data = orjson.loads(response.content)
+        logger.debug("IP:%s - 高德原生响应: %s", ip, raw_data)
+        # HTTP 200 也可能携带错误（Key无效/配额超限等），仅 status == "1" 视为成功
+        if raw_data.get("status") == "1":
+            return raw_data
+        # infocode 2xxxx 为请求参数类错误（单个IP无数据），1xxxx/3xxxx 为鉴权/配额/服务故障
+        if str(raw_data.get("infocode", "")).startswith("2"):
+            logger.info("IP:%s - 高德原生接口无该IP数据: %s", ip, raw_data.get("info"))
+            return {}
+        logger.warning("IP:%s - 高德原生接口响应异常: %s", ip, raw_data)
+        return None
     except Exception as e:
-        logger.error(f"IP:{ip} - 高德原生接口失败: {str(e)}", exc_info=True)
+        logger.error("IP:%s - 高德原生接口失败: %s", ip, e, exc_info=logger.isEnabledFor(logging.DEBUG))
         return None
 
-def query_baidu_opendata_native(ip: str) -> Optional[Dict[str, Any]]:
+@cache_raw_response("百度开放平台")
+async def query_baidu_opendata_native(ip: str) -> Optional[Dict[str, Any]]:
     """百度开放平台原生接口调用（新增，返回原生响应）"""
-    logger.info(f"IP:{ip} - 选用上游接口：百度开放平台")
+    logger.debug("IP:%s - 选用上游接口：百度开放平台", ip)
     try:
         url = "https://opendata.baidu.com/api.php"
         params = {"query": ip, "co": "", "resource_id": "6006", "oe": "utf8"}
-        logger.debug(f"IP:{ip} - 百度开放平台请求参数: {params}")
-        response = requests.get(url, params=params, timeout=5)
-        raw_data = response.json()
-        logger.debug(f"IP:{ip} - 百度开放平台原生响应: {raw_data}")
-        if raw_data.get("status") == "0" and raw_data.get("data"):
-            return raw_data
-        logger.warning(f"IP:{ip} - 百度开放平台响应异常: {raw_data}")
+        logger.debug("IP:%s - 百度开放平台请求参数: %s", ip, params)
+        response = await client.get(url, params=params)
+        raw_data = orjson.loads(response.content)
+        logger.debug("IP:%s - 百度开放平台原生响应: %s", ip, raw_data)
+        if raw_data.get("status") == "0":
+            if raw_data.get("data"):
+                return raw_data
+            logger.info("IP:%s - 百度开放平台无该IP数据", ip)
+            return {}
+        logger.warning("IP:%s - 百度开放平台响应异常: %s", ip, raw_data)
         return None
     except Exception as e:
-        logger.error(f"IP:{ip} - 百度开放平台接口失败: {str(e)}", exc_info=True)
+        logger.error("IP:%s - 百度开放平台接口失败: %s", ip, e, exc_info=logger.isEnabledFor(logging.DEBUG))
         return None
 
-def query_pconline_native(ip: str) -> Optional[Dict[str, Any]]:
+@cache_raw_response("PConline")
+async def query_pconline_native(ip: str) -> Optional[Dict[str, Any]]:
     """PConline原生接口调用（新增，返回原生响应）"""
-    logger.info(f"IP:{ip} - 选用上游接口：PConline")
+    logger.debug("IP:%s - 选用上游接口：PConline", ip)
     try:
         url = "http://whois.pconline.com.cn/ipJson.jsp"
         params = {"ip": ip, "json": "true"}
-        logger.debug(f"IP:{ip} - PConline请求参数: {params}")
-        response = requests.get(url, params=params, timeout=5)
-        response.encoding = "gbk"
-        raw_data = response.json()
-        logger.debug(f"IP:{ip} - PConline原生响应: {raw_data}")
+        logger.debug("IP:%s - PConline请求参数: %s", ip, params)
+        response = await client.get(url, params=params)
+        raw_data = orjson.loads(response.content.decode("gbk"))  # PConline响应为GBK编码
+        logger.debug("IP:%s - PConline原生响应: %s", ip, raw_data)
         if not raw_data.get("err"):
             return raw_data
-        logger.warning(f"IP:{ip} - PConline响应错误: {raw_data.get('err')}")
-        return None
+        # err 为 noprovince 等：该IP无数据（内网/未知IP），上游本身正常
+        logger.info("IP:%s - PConline无该IP数据: %s", ip, raw_data.get('err'))
+        return {}
     except Exception as e:
-        logger.error(f"IP:{ip} - PConline接口失败: {str(e)}", exc_info=True)
+        logger.error("IP:%s - PConline接口失败: %s", ip, e, exc_info=logger.isEnabledFor(logging.DEBUG))
         return None
 
+# -------------------------- 上游调度表 --------------------------
+# 上游调用统一签名为 (ip, coor)，调度表在模块加载时构建一次，请求期间不再重复创建
+# 每项为 (上游名称, 调用函数, 原生响应缓存查询函数)
+UpstreamFunc = Callable[[str, str], Awaitable[Optional[Dict[str, Any]]]]
+PeekFunc = Callable[[str, str], Optional[Dict[str, Any]]]
+Upstream = Tuple[str, UpstreamFunc, PeekFunc]
+
+_BAIDU_DEFAULT_UPSTREAM: Upstream = (
+    "百度地图原生接口",
+    lambda ip, coor: query_baidu_map_native(ip, coor, BAIDU_DEFAULT_AK),
+    lambda ip, coor: query_baidu_map_native.peek_cache(ip, coor, BAIDU_DEFAULT_AK)
+)
+_AMAP_DEFAULT_UPSTREAM: Upstream = (
+    "高德地图原生接口",
+    lambda ip, coor: query_amap_ip_native(ip, AMAP_DEFAULT_KEY),
+    lambda ip, coor: query_amap_ip_native.peek_cache(ip, AMAP_DEFAULT_KEY)
+)
+
+# 第二优先级：免密钥上游（优先级低）
+_KEYLESS_UPSTREAMS: Tuple[Upstream, ...] = (
+    ("百度开放平台",
+     lambda ip, coor: query_baidu_opendata_native(ip),
+     lambda ip, coor: query_baidu_opendata_native.peek_cache(ip)),
+    ("PConline",
+     lambda ip, coor: query_pconline_native(ip),
+     lambda ip, coor: query_pconline_native.peek_cache(ip))
+)
+
+# 降级调度表按优先级分层：第一层为默认密钥上游，第二层为免密钥上游
+# 层与层之间顺序固定，层内按实时健康度排序，原生格式即目标格式的上游略有优惠（见 order_upstreams）
+_FALLBACK_UPSTREAMS: Tuple[Tuple[Upstream, ...], ...] = (
+    ((_BAIDU_DEFAULT_UPSTREAM,) if BAIDU_DEFAULT_AK else ())
+    + ((_AMAP_DEFAULT_UPSTREAM,) if AMAP_DEFAULT_KEY else ()),
+    _KEYLESS_UPSTREAMS
+)
+
+# -------------------------- 熔断器 --------------------------
+class CircuitBreaker:
+    """
+    上游熔断器（关闭 → 打开 → 半开）：
+    1. 关闭：正常放行，连续失败达到 fail_max 次后打开
+    2. 打开：直接跳过该上游，持续 reset_timeout 秒
+    3. 半开：冷却结束后放行一次探测请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, fail_max: int = 5, reset_timeout: float = 30.0):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    def allow(self) -> bool:
+        """判断当前是否允许调用上游"""
+        if self.opened_at is None:
+            return True
+        if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.probing = True  # 进入半开状态，仅放行一次探测
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probing or self.failures >= self.fail_max:
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def record_cancel(self) -> None:
+        """调用被取消（并发竞速中落败）时不计入失败，释放半开探测名额"""
+        self.probing = False
+
+# 每个上游一个熔断器（仅作用于默认密钥/免密钥的降级链路）
+_BREAKERS = {
+    name: CircuitBreaker(fail_max=5, reset_timeout=30.0)
+    for name in ("百度地图原生接口", "高德地图原生接口", "百度开放平台", "PConline")
+}
+
+# -------------------------- 上游健康度 --------------------------
+# 每个上游成功响应耗时的指数加权移动平均（EWMA，毫秒），结合熔断器的连续失败次数计算得分，
+# 得分越低越优先；同层上游按得分排序，使最快且健康的上游成为首选
+_EWMA_ALPHA = 0.1
+_FAILURE_PENALTY_MS = 1000.0
+# 原生格式即目标格式的上游免去格式转换，仅给予少量得分优惠，明显更快的上游仍排在前面
+_NATIVE_FORMAT_BONUS_MS = 20.0
+_UPSTREAM_LATENCY_MS: Dict[str, float] = {name: 100.0 for name in _BREAKERS}
+
+def record_latency(name: str, elapsed_ms: float) -> None:
+    """更新上游耗时EWMA"""
+    _UPSTREAM_LATENCY_MS[name] = (1 - _EWMA_ALPHA) * _UPSTREAM_LATENCY_MS[name] + _EWMA_ALPHA * elapsed_ms
+
+def record_latency_floor(name: str, elapsed_ms: float) -> None:
+    """
+    已耗时仅为真实耗时的下限（如竞速落败被取消）：
+    超过当前EWMA时按普通样本平滑计入，否则不含有效信息，忽略
+    """
+    if elapsed_ms > _UPSTREAM_LATENCY_MS[name]:
+        record_latency(name, elapsed_ms)
+
+def upstream_score(name: str) -> float:
+    """上游得分 = 耗时EWMA + 连续失败惩罚"""
+    return _UPSTREAM_LATENCY_MS[name] + _BREAKERS[name].failures * _FAILURE_PENALTY_MS
+
+def order_upstreams(tiers: Tuple[Tuple[Upstream, ...], ...], preferred: str = "") -> Tuple[Upstream, ...]:
+    """
+    层间保持优先级顺序，层内按得分升序排列（得分相同保持配置顺序）；
+    原生格式与目标格式一致的上游（preferred）可直接原样返回，得分减去 _NATIVE_FORMAT_BONUS_MS
+    """
+    def sort_key(upstream: Upstream) -> float:
+        score = upstream_score(upstream[0])
+        return score - _NATIVE_FORMAT_BONUS_MS if upstream[0] == preferred else score
+
+    return tuple(
+        upstream
+        for tier in tiers
+        for upstream in sorted(tier, key=sort_key)
+    )
+
+async def call_upstream(ip: str, coor: str, name: str, func: UpstreamFunc,
+                        peek: PeekFunc) -> Optional[Dict[str, Any]]:
+    """经熔断器调用上游，熔断打开时立即跳过，并记录耗时"""
+    # 原生响应缓存命中时直接返回：未实际请求上游，不参与熔断判定与耗时统计，
+    # 避免半开探测被缓存应答而误关闭熔断器
+    cached = peek(ip, coor)
+    if cached is not None:
+        logger.debug("IP:%s - %s命中原生响应缓存", ip, name)
+        return cached
+    breaker = _BREAKERS[name]
+    if not breaker.allow():
+        logger.warning("IP:%s - 上游%s已熔断，跳过", ip, name)
+        return None
+    start = time.monotonic()
+    try:
+        raw_result = await func(ip, coor)
+    except asyncio.CancelledError:
+        # 竞速落败被取消：已耗时只是该上游真实耗时的下限，不作为样本计入，仅用于抬高EWMA下限
+        record_latency_floor(name, (time.monotonic() - start) * 1000)
+        breaker.record_cancel()
+        raise
+    if raw_result is None:
+        breaker.record_failure()
+    else:
+        # 含无数据应答（空字典）：上游已正常响应，同样视为健康
+        record_latency(name, (time.monotonic() - start) * 1000)
+        breaker.record_success()
+    return raw_result
+
+# -------------------------- 上游并发竞速 --------------------------
+# 对冲请求：先调用最高优先级上游，若 HEDGE_DELAY 秒内未返回或已失败，
+# 再追加下一个上游并发执行，取最先成功的结果，其余任务取消
+HEDGE_DELAY = 0.2
+RACE_TIMEOUT = 6.0
+
+async def race_upstreams(ip: str, coor: str, upstreams: Tuple[Upstream, ...]) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """按优先级错峰并发调用上游，返回 (上游名称, 原生响应)，全部失败返回None"""
+    remaining_upstreams = iter(upstreams)
+    task_names: Dict[asyncio.Task, str] = {}
+    pending = set()
+    deadline = time.monotonic() + RACE_TIMEOUT
+
+    def launch_next() -> bool:
+        item = next(remaining_upstreams, None)
+        if item is None:
+            return False
+        name, func, peek = item
+        logger.debug("IP:%s - 尝试上游：%s", ip, name)
+        task = asyncio.create_task(call_upstream(ip, coor, name, func, peek))
+        task_names[task] = name
+        pending.add(task)
+        return True
+
+    try:
+        launch_next()
+        while pending:
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                logger.warning("IP:%s - 上游竞速超时（%ss）", ip, RACE_TIMEOUT)
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=min(HEDGE_DELAY, time_left), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                raw_result = task.result()
+                if raw_result:
+                    return task_names[task], raw_result
+            # 超过对冲延迟仍无结果，或已有上游失败 → 追加下一个上游
+            if not launch_next() and not pending:
+                break
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+# -------------------------- 并发请求合并 --------------------------
+# 同一IP的并发查询只触发一次上游调用，其余请求等待同一结果（singleflight）
+_INFLIGHT: Dict[Tuple[Any, ...], asyncio.Task] = {}
+
+async def singleflight(key: Tuple[Any, ...], func: Callable[[], Awaitable[Any]]) -> Any:
+    """相同key的请求进行中时直接等待其结果，否则以func创建共享任务并等待"""
+    task = _INFLIGHT.get(key)
+    if task is None:
+        # func在独立任务中执行，所有等待者（含发起者）均经shield等待：
+        # 任一等待者被取消（如客户端断开）都不会中断共享任务或影响其他等待者
+        task = asyncio.ensure_future(func())
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _INFLIGHT.pop(key, None))
+        # 无等待者时异常也视为已读取，避免"exception was never retrieved"告警
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return await asyncio.shield(task)
+
+# -------------------------- 高德风格错误响应 --------------------------
+# 固定内容的错误响应在模块加载时预序列化，错误路径直接返回字节，免去字典构建与JSON编码
+def _amap_error_body(info: str, infocode: str) -> bytes:
+    return orjson.dumps({
+        "status": "0",
+        "info": info,
+        "infocode": infocode,
+        "province": "",
+        "city": "",
+        "adcode": "",
+        "rectangle": ""
+    })
+
+_AMAP_ERR_INVALID_IP = _amap_error_body("无效的IPv4地址格式", "10001")
+_AMAP_ERR_ALL_FAILED = _amap_error_body("所有上游接口均不可用", "10003")
+
+def amap_error_response(body: bytes) -> Response:
+    """返回预序列化的高德风格错误响应"""
+    return Response(content=body, media_type="application/json")
+
+# -------------------------- 降级链路 --------------------------
+# 通用接口无密钥时的目标格式轮换计数器（替代随机选择）
+_FORMAT_COUNTER = itertools.count()
+
+# 目标格式 → 原生即为该格式的上游 / 格式转换函数
+_NATIVE_UPSTREAM_OF_FORMAT = {"baidu": "百度地图原生接口", "amap": "高德地图原生接口"}
+_FORMATTERS = {"baidu": to_baidumap_format, "amap": to_amap_format}
+
+async def resolve_fallback(ip: str, ip_int: int, coor: str, target_format: str) -> Optional[Dict[str, Any]]:
+    """
+    降级链路（两个接口共用）：
+    查缓存 → 合并同IP并发请求 → 按优先级错峰竞速上游 → 转换为目标格式并缓存
+    全部上游失败返回None（失败结果短期缓存）
+    """
+    # 坐标类型仅影响百度格式，高德格式的缓存与请求合并不区分coor
+    cache_key = (target_format, ip_int, coor if target_format == "baidu" else "")
+    cached = _LOC_CACHE.get(cache_key)
+    if cached is not None:
+        logger.debug("IP:%s - 命中缓存", ip)
+        return cached
+    if cache_key in _LOC_NEG_CACHE:
+        logger.debug("IP:%s - 命中失败缓存", ip)
+        return None
+    
+    all_upstreams = order_upstreams(_FALLBACK_UPSTREAMS, _NATIVE_UPSTREAM_OF_FORMAT[target_format])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("IP:%s - 降级上游顺序（第一优先级→第二优先级）: %s, 目标格式: %s",
+                     ip, [name for name, *_ in all_upstreams], target_format)
+    
+    race_result = await singleflight(cache_key, lambda: race_upstreams(ip, coor, all_upstreams))
+    if not race_result:
+        logger.error("IP:%s - 所有降级上游均失败", ip)
+        _LOC_NEG_CACHE[cache_key] = True
+        return None
+    
+    name, raw_result = race_result
+    formatted_result = _FORMATTERS[target_format](raw_result, ip, name)
+    logger.info("IP:%s - 降级上游%s返回成功，目标格式: %s", ip, name, target_format)
+    _LOC_CACHE[cache_key] = formatted_result
+    return formatted_result
+
 # -------------------------- 接口定义 --------------------------
-@app.get("/location/ip", description="通用IP查询接口（原生格式+自动转换）")
+@app.get("/location/ip", description="通用IP查询接口（原生格式+自动转换）", response_model=None)
 async def get_ip_location(
     ip: str = Query(..., description="待查询IPv4地址"),
     coor: str = Query("bd09ll", description="坐标类型（仅百度地图使用）"),
@@ -251,153 +640,65 @@ async def get_ip_location(
     1. 提供ak → 百度原生格式
     2. 不提供 → 先尝试默认密钥上游（优先级高），再尝试免密钥上游
     """
-    logger.info(f"IP:{ip} - 收到通用查询请求，ak={'提供' if ak else '未提供'}，key={'提供' if key else '未提供'}")
+    logger.debug("IP:%s - 收到通用查询请求，ak=%s，key=%s", ip, "提供" if ak else "未提供", "提供" if key else "未提供")
     
-    # IP校验
-    if not is_valid_ip(ip):
-        logger.warning(f"IP:{ip} - 无效IPv4格式")
+    # IP校验（同时得到整数形式，作为缓存键）
+    ip_int = parse_ipv4(ip)
+    if ip_int is None:
+        logger.warning("IP:%s - 无效IPv4格式", ip)
         raise HTTPException(status_code=400, detail="无效的IPv4地址格式")
     
     # 1. 提供ak → 百度原生
     if ak:
-        result = query_baidu_map_native(ip, coor, ak)
+        result = await query_baidu_map_native(ip, coor, ak)
         if result:
-            logger.info(f"IP:{ip} - 百度原生接口返回成功")
+            logger.info("IP:%s - 百度原生接口返回成功", ip)
             return result
         raise HTTPException(status_code=503, detail="百度地图接口调用失败（AK无效/网络异常）")
     
-    # 2. 无密钥 → 优先级：默认密钥上游（第一优先级）> 免密钥上游（第二优先级）
-    # 第一优先级：默认密钥对应的上游（优先级高）
-    first_priority = []
-    if BAIDU_DEFAULT_AK:
-        first_priority.append(("百度地图原生接口", lambda: query_baidu_map_native(ip, coor, BAIDU_DEFAULT_AK)))
-    if AMAP_DEFAULT_KEY:
-        first_priority.append(("高德地图原生接口", lambda: query_amap_ip_native(ip, AMAP_DEFAULT_KEY)))
-    
-    # 第二优先级：免密钥上游（优先级低）
-    second_priority = [
-        ("百度开放平台", lambda: query_baidu_opendata_native(ip)),
-        ("PConline", lambda: query_pconline_native(ip))
-    ]
-    
-    # 合并所有上游（第一优先级在前，第二优先级在后）
-    all_upstreams = first_priority.copy()
-    all_upstreams.extend(second_priority)
-    
-    if not all_upstreams:
-        raise HTTPException(status_code=500, detail="未配置默认密钥，且无可用免密钥上游")
-    
-    # 随机选择目标格式（百度/高德）
-    target_format = random.choice(["baidu", "amap"])
-    logger.info(f"IP:{ip} - 无密钥，上游顺序（第一优先级→第二优先级）: {[name for name, _ in all_upstreams]}, 目标格式: {target_format}")
-    
-    # 按顺序尝试所有上游（先第一优先级，再第二优先级）
-    for name, func in all_upstreams:
-        logger.info(f"IP:{ip} - 尝试上游：{name}")
-        raw_result = func()
-        if raw_result:
-            if target_format == "baidu":
-                formatted_result = to_baidumap_format(raw_result, ip, name)
-                logger.info(f"IP:{ip} - 转换为百度格式成功")
-                return formatted_result
-            else:
-                formatted_result = to_amap_format(raw_result, ip, name)
-                logger.info(f"IP:{ip} - 转换为高德格式成功")
-                return formatted_result
-    
-    raise HTTPException(status_code=503, detail="所有上游接口均不可用，请稍后再试")
+    # 2. 无密钥 → 降级链路，目标格式轮流选择（百度/高德各占一半）
+    target_format = "baidu" if next(_FORMAT_COUNTER) & 1 else "amap"
+    result = await resolve_fallback(ip, ip_int, coor, target_format)
+    if result is None:
+        raise HTTPException(status_code=503, detail="所有上游接口均不可用，请稍后再试")
+    return result
 
-@app.get("/v3/ip", description="高德地图风格IP查询接口（始终返回高德原生格式）")
+@app.get("/v3/ip", description="高德地图风格IP查询接口（始终返回高德原生格式）", response_model=None)
 async def amap_style_ip_query(
     ip: str = Query(..., description="待查询IPv4地址"),
     key: Optional[str] = Query(None, description="高德地图Key（可选，不提供则自动降级）")
-) -> Dict[str, Any]:
+) -> Union[Dict[str, Any], Response]:
     """
     逻辑（与原有一致）：
     1. 提供key → 高德原生格式
     2. 不提供key → 先尝试默认密钥上游（优先级高），再尝试免密钥上游
     """
-    logger.info(f"IP:{ip} - 收到高德风格查询请求，key={'提供' if key else '未提供'}")
+    logger.debug("IP:%s - 收到高德风格查询请求，key=%s", ip, "提供" if key else "未提供")
     
-    # IP校验
-    if not is_valid_ip(ip):
-        logger.warning(f"IP:{ip} - 无效IPv4格式")
-        return {
-            "status": "0",
-            "info": "无效的IPv4地址格式",
-            "infocode": "10001",
-            "province": "",
-            "city": "",
-            "adcode": "",
-            "rectangle": ""
-        }
+    # IP校验（同时得到整数形式，作为缓存键）
+    ip_int = parse_ipv4(ip)
+    if ip_int is None:
+        logger.warning("IP:%s - 无效IPv4格式", ip)
+        return amap_error_response(_AMAP_ERR_INVALID_IP)
     
     # 1. 提供key → 高德原生
     if key:
-        result = query_amap_ip_native(ip, key)
+        result = await query_amap_ip_native(ip, key)
         if result:
-            logger.info(f"IP:{ip} - 高德原生接口返回成功")
+            logger.info("IP:%s - 高德原生接口返回成功", ip)
             return result
-        logger.warning(f"IP:{ip} - 高德原生接口失败，自动降级")
-    
-    # 2. 降级 → 优先级：默认密钥上游（第一优先级）> 免密钥上游（第二优先级）
-    # 第一优先级：默认密钥对应的上游（优先级高）
-    first_priority = []
-    if AMAP_DEFAULT_KEY:
-        first_priority.append(("高德地图原生接口", lambda: query_amap_ip_native(ip, AMAP_DEFAULT_KEY)))
-    if BAIDU_DEFAULT_AK:
-        first_priority.append(("百度地图原生接口", lambda: query_baidu_map_native(ip, "bd09ll", BAIDU_DEFAULT_AK)))
-    
-    # 第二优先级：免密钥上游（优先级低）
-    second_priority = [
-        ("百度开放平台", lambda: query_baidu_opendata_native(ip)),
-        ("PConline", lambda: query_pconline_native(ip))
-    ]
-    
-    # 合并所有上游（第一优先级在前，第二优先级在后）
-    all_upstreams = first_priority.copy()
-    all_upstreams.extend(second_priority)
-    
-    if not all_upstreams:
-        logger.error(f"IP:{ip} - 无可用降级上游")
-        return {
-            "status": "0",
-            "info": "无可用上游接口（未配置默认密钥）",
-            "infocode": "10002",
-            "province": "",
-            "city": "",
-            "adcode": "",
-            "rectangle": ""
-        }
-    
-    logger.info(f"IP:{ip} - 降级上游顺序（第一优先级→第二优先级）: {[name for name, _ in all_upstreams]}")
-    
-    # 按顺序尝试所有上游（先第一优先级，再第二优先级）
-    for name, func in all_upstreams:
-        logger.info(f"IP:{ip} - 尝试降级上游：{name}")
-        raw_result = func()
-        if raw_result:
-            formatted_result = to_amap_format(raw_result, ip, name)
-            logger.info(f"IP:{ip} - 降级转换为高德格式成功")
-            return formatted_result
+        logger.warning("IP:%s - 高德原生接口失败，自动降级", ip)
     
-    # 所有上游失败
-    logger.error(f"IP:{ip} - 所有降级上游均失败")
-    return {
-        "status": "0",
-        "info": "所有上游接口均不可用",
-        "infocode": "10003",
-        "province": "",
-        "city": "",
-        "adcode": "",
-        "rectangle": ""
-    }
+    # 2. 降级链路，始终转换为高德格式
+    result = await resolve_fallback(ip, ip_int, "bd09ll", "amap")
+    if result is None:
+        return amap_error_response(_AMAP_ERR_ALL_FAILED)
+    return result
 
-@app.get("/health", description="服务健康检查接口")
+@app.get("/health", description="服务健康检查接口", response_model=None)
 async def health_check() -> Dict[str, str]:
     """健康检查接口（Docker监控用）"""
-    tz = timezone.utc
-    local_time = datetime.now(tz).astimezone().strftime("%Y-%m-%dT%H:%M:%S%z")
+    local_time = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime())
     return {
         "status": "healthy",
         "version": "3.2",
@@ -407,4 +708,5 @@ async def health_check() -> Dict[str, str]:
 if __name__ == "__main__":
     import uvicorn
     # 生产环境用info级别，调试时改为debug
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
\ No newline at end of file
+    # loop/http 为 auto 时，已安装 uvloop/httptools（uvicorn[standard]）则自动启用，Windows 下回退到 asyncio
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto", log_level="info")
\ No newline at end of file